@@ -1,22 +1,45 @@
 #!/usr/bin/env python3
 
 import argparse
-import asyncio
-import ffmpeg
-from dataclasses import dataclass
-from datetime import datetime
+import mmap
+import msgspec
+import os
+import re
+import shutil
+import stat
+import struct
+import subprocess
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import suppress
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from itertools import islice
 from pathlib import Path
-from typing import Iterator
+from typing import Callable, Iterable, Iterator
 
 
-@dataclass
+# Timestamps in MP4 headers count seconds since midnight, Jan. 1, 1904 (UTC)
+MP4_EPOCH = datetime(1904, 1, 1)
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+# Matches files that were already renamed, e.g. `foo_1920x1080_30fps_2022-12-27T153320.mp4`
+RENAMED_PATTERN = re.compile(r"_\d+x\d+_\d+fps_\d{4}-\d{2}-\d{2}T\d{6}\.[^./\\]*$")
+
+# Metadata extracted on previous runs, keyed by file path
+CACHE_FILE = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"),
+                  "renamevideos", "index.msgpack")
+
+
+@dataclass(slots=True, frozen=True)
 class CmdArgs:
-    input_files: list[Path]
+    input_files: list[str]
     prefix: str
+    slow: bool
     verbose: int
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class VideoInfo:
     path: Path
     fps: int
@@ -24,6 +47,61 @@ class VideoInfo:
     creation_time: datetime
 
 
+@dataclass(slots=True)
+class VideoTable:
+    """
+    Metadata for many video files, stored column-wise. Creation times are kept
+    as seconds since the Unix epoch.
+    """
+
+    paths: list[str] = field(default_factory=list)
+    fps: array = field(default_factory=lambda: array("q"))
+    widths: array = field(default_factory=lambda: array("q"))
+    heights: array = field(default_factory=lambda: array("q"))
+    creation_times: array = field(default_factory=lambda: array("q"))
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def append(self, path: str, fps: int, width: int, height: int, creation_time: datetime) -> None:
+        # Reject bogus values up front so that a row is never half appended
+        if not all(-2**63 <= v < 2**63 for v in (fps, width, height)):
+            raise ValueError("Metadata out of range")
+
+        self.paths.append(path)
+        self.fps.append(fps)
+        self.widths.append(width)
+        self.heights.append(height)
+        self.creation_times.append((creation_time - UNIX_EPOCH) // timedelta(seconds=1))
+
+    def creation_time(self, i: int) -> datetime:
+        return UNIX_EPOCH + timedelta(seconds=self.creation_times[i])
+
+
+class ProbeTags(msgspec.Struct):
+    creation_time: str
+
+
+class ProbeStream(msgspec.Struct):
+    width: int
+    height: int
+    r_frame_rate: str
+    tags: ProbeTags
+
+
+class Probe(msgspec.Struct):
+    streams: list[ProbeStream]
+
+
+class CacheEntry(msgspec.Struct, array_like=True):
+    mtime_ns: int
+    size: int
+    fps: int
+    width: int
+    height: int
+    creation_time: datetime
+
+
 def parse_args() -> CmdArgs:
     """
     Parses command line arguments and returns a CmdArgs object containing the
@@ -47,6 +125,11 @@ def parse_args() -> CmdArgs:
         default="",
         nargs="?")
 
+    parser.add_argument(
+        "--slow",
+        help="Extract metadata with ffprobe instead of parsing MP4 headers",
+        action="store_true")
+
     parser.add_argument(
         "-v", "--verbose",
         help="Enable verbose mode",
@@ -55,36 +138,69 @@ def parse_args() -> CmdArgs:
 
     args = parser.parse_args()
 
+    if args.slow and not shutil.which("ffprobe"):
+        parser.error("--slow requires ffprobe to be installed")
+
     return CmdArgs(
         input_files=build_video_list(
             args.input,
             verbose=args.verbose
         ),
         prefix=args.prefix,
+        slow=args.slow,
         verbose=args.verbose
     )
 
 
-def find_video_files(root: Path, ext: str = ".mp4") -> Iterator[Path]:
+def find_video_files(root: str, ext: str = ".mp4") -> Iterator[str]:
     """
     Recursively searches for video files under a root directory. Only files with
     the provided file extension are returned.
     """
 
-    for path in root.iterdir():
-        if path.is_dir():
-            yield from find_video_files(path)
-        elif path.is_file and path.suffix.lower() == ext:
-            yield path
-
-
-def build_video_list(path: str, verbose: int = 0) -> list[Path]:
+    # On POSIX, keep a file descriptor open for each directory so that files
+    # can be checked with `fstatat` instead of resolving their full path. The
+    # trailing separator makes `fwalk` follow the root itself when it's a
+    # symlink to a directory, while links found below it are still skipped
+    if hasattr(os, "fwalk"):
+        top = os.path.join(root, "")
+        for dirpath, _, filenames, dirfd in os.fwalk(top, follow_symlinks=False):
+            # Filter on the extension before touching the filesystem. Names are
+            # only lowercased when they do not match as-is
+            matching = [f for f in filenames
+                        if f.endswith(ext) or f.lower().endswith(ext)]
+            for name in matching:
+                # `fwalk` doesn't expose the file type of non-directories, so
+                # matching names need one `fstatat` to rule out links, pipes, etc
+                try:
+                    st = os.stat(name, dir_fd=dirfd, follow_symlinks=False)
+                except OSError:
+                    # File vanished since the directory was listed
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    yield os.path.join(dirpath, name)
+        return
+
+    # Elsewhere fall back to `os.scandir`, whose entries cache the file type so
+    # no extra `stat` calls are needed to tell directories apart
+    stack = [os.fspath(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif (entry.name.endswith(ext) or entry.name.lower().endswith(ext)) \
+                        and entry.is_file(follow_symlinks=False):
+                    yield entry.path
+
+
+def build_video_list(path: str, verbose: int = 0) -> list[str]:
     """
     Builds a list containing all video files found under the root dir. By
     default only searches video files with `.mp4` extension.
     """
 
-    video_files = [f for f in find_video_files(Path(path))]
+    video_files = list(find_video_files(path))
 
     if verbose >= 1:
         print(f"Found {len(video_files)} video files under `{path}`")
@@ -92,77 +208,361 @@ def build_video_list(path: str, verbose: int = 0) -> list[Path]:
     return video_files
 
 
-def parse_video_file(filename: Path) -> VideoInfo | None:
+def iter_boxes(buf: mmap.mmap, start: int, end: int) -> Iterator[tuple[bytes, int, int]]:
+    """
+    Iterates over the MP4 boxes (atoms) found in `buf[start:end]`, yielding
+    their type along with the start and end offsets of their payload.
+    """
+
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", buf, offset)
+        header = 8
+        if size == 1:
+            # 64-bit box size stored right after the box type
+            size, = struct.unpack_from(">Q", buf, offset + 8)
+            header = 16
+        elif size == 0:
+            # Box extends to the end of its parent
+            size = end - offset
+        if size < header or offset + size > end:
+            raise ValueError(f"Malformed `{kind.decode(errors='replace')}` box")
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def find_box(buf: mmap.mmap, start: int, end: int, kind: bytes) -> tuple[int, int]:
+    """
+    Returns the payload offsets of the first box of the given type found in
+    `buf[start:end]`.
+    """
+
+    for box_kind, box_start, box_end in iter_boxes(buf, start, end):
+        if box_kind == kind:
+            return box_start, box_end
+    raise ValueError(f"Missing `{kind.decode()}` box")
+
+
+def parse_mp4_file(filename: str) -> VideoInfo:
+    """
+    Extracts video metadata by reading the MP4 headers directly. Only the boxes
+    holding the metadata we care about are visited:
+
+        moov/trak/tkhd                  -> resolution
+        moov/trak/mdia/mdhd             -> timescale and creation time
+        moov/trak/mdia/minf/stbl/stts   -> sample duration (frame rate)
+    """
+
+    with open(filename, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        moov = find_box(buf, 0, len(buf), b"moov")
+        for kind, start, end in iter_boxes(buf, *moov):
+            if kind != b"trak":
+                continue
+
+            # Skip audio, subtitle, etc tracks
+            mdia = find_box(buf, start, end, b"mdia")
+            hdlr, _ = find_box(buf, *mdia, b"hdlr")
+            if buf[hdlr + 8:hdlr + 12] != b"vide":
+                continue
+
+            # Resolution is stored as 16.16 fixed-point numbers
+            tkhd, tkhd_end = find_box(buf, start, end, b"tkhd")
+            offset = tkhd + (88 if buf[tkhd] == 1 else 76)
+            if offset + 8 > tkhd_end:
+                raise ValueError("Truncated `tkhd` box")
+            width, height = struct.unpack_from(">II", buf, offset)
+
+            mdhd, mdhd_end = find_box(buf, *mdia, b"mdhd")
+            if mdhd + (24 if buf[mdhd] == 1 else 16) > mdhd_end:
+                raise ValueError("Truncated `mdhd` box")
+            if buf[mdhd] == 1:
+                creation_time, = struct.unpack_from(">Q", buf, mdhd + 4)
+                timescale, = struct.unpack_from(">I", buf, mdhd + 20)
+            else:
+                creation_time, = struct.unpack_from(">I", buf, mdhd + 4)
+                timescale, = struct.unpack_from(">I", buf, mdhd + 12)
+
+            # A zero creation time means it was never set (ffprobe leaves the
+            # tag out in that case)
+            if creation_time == 0:
+                raise ValueError("Creation time is not set")
+
+            # Frame rate is derived from the duration of the first sample
+            minf = find_box(buf, *mdia, b"minf")
+            stbl = find_box(buf, *minf, b"stbl")
+            stts, stts_end = find_box(buf, *stbl, b"stts")
+            if stts + 16 > stts_end:
+                raise ValueError("Truncated `stts` box")
+
+            # Fragmented MP4s keep their samples in `moof` boxes instead
+            entry_count, sample_delta = struct.unpack_from(">I4xI", buf, stts + 4)
+            if entry_count == 0:
+                raise ValueError("No samples in `stts` box")
+
+            fps = round(timescale / sample_delta)
+            if fps == 0:
+                raise ValueError("Invalid frame rate")
+
+            return VideoInfo(
+                path=Path(filename),
+                fps=fps,
+                resolution=(width >> 16, height >> 16),
+                creation_time=MP4_EPOCH + timedelta(seconds=creation_time)
+            )
+
+    raise ValueError("No video track found")
+
+
+def parse_timestamp(t: str) -> datetime:
+    """
+    Parses a timestamp in the fixed format used by ffprobe, e.g.
+    `2021-03-04T05:06:07.000000Z`. Much cheaper than `datetime.strptime`.
+    """
+
+    return datetime(int(t[0:4]), int(t[5:7]), int(t[8:10]),
+                    int(t[11:13]), int(t[14:16]), int(t[17:19]), int(t[20:26]))
+
+
+def probe_video_file(filename: str) -> VideoInfo:
+    """
+    Extracts video metadata by running ffprobe. Only the fields we care about
+    are requested, and its JSON output is decoded straight into a Probe object.
+    """
+
+    # Tries to retrieve video metadata in JSON format
+    proc = subprocess.run(
+        ["ffprobe", "-v", "error",
+         "-select_streams", "v:0",
+         "-show_entries", "stream=width,height,r_frame_rate:stream_tags=creation_time",
+         "-of", "json",
+         filename],
+        capture_output=True,
+        check=True)
+    info = msgspec.json.decode(proc.stdout, type=Probe).streams[0]
+
+    # Frame rate is a fraction, e.g. `30000/1001` for NTSC. Round it the same
+    # way as the MP4 parser does, so both give the same filenames
+    num, _, den = info.r_frame_rate.partition("/")
+    fps = round(int(num) / int(den or 1))
+    if fps == 0:
+        raise ValueError("Invalid frame rate")
+
+    # Build VideoInfo object from JSON metadata
+    return VideoInfo(
+        path=Path(filename),
+        fps=fps,
+        resolution=(info.width, info.height),
+        creation_time=parse_timestamp(info.tags.creation_time)
+    )
+
+
+def parse_video_file(filename: str, slow: bool = False) -> VideoInfo | None:
     """
     Parses a video file and returns its metadata packaged as a VideoInfo object.
+    Unless `slow` is set, metadata is read straight from the MP4 headers instead
+    of spawning ffprobe for every file.
+    """
+
+    try:
+        if slow:
+            return probe_video_file(filename)
+        return parse_mp4_file(filename)
+    except (OSError, ValueError, IndexError, OverflowError, ZeroDivisionError,
+            struct.error, subprocess.CalledProcessError, msgspec.DecodeError):
+        # Files that can't be read or lack some metadata are left untouched,
+        # so a single corrupt video doesn't abort the whole run
+        return None
+
+
+def parse_video_files_batch(filenames: list[str], slow: bool = False) -> VideoTable:
+    """
+    Parses a batch of video files in one go, so that a single round trip to a
+    worker process covers the whole batch. Files that can't be parsed are left
+    out of the returned table.
+    """
+
+    table = VideoTable()
+    for filename in filenames:
+        if video := parse_video_file(filename, slow):
+            try:
+                table.append(filename, video.fps, *video.resolution, video.creation_time)
+            except ValueError:
+                continue
+
+    return table
+
+
+def parse_video_files(filenames: Iterable[str], slow: bool = False, batch_size: int = 64) -> Iterator[VideoTable]:
+    """
+    Parses video files in a pool of worker processes, yielding a VideoTable for
+    each batch as soon as it's done. Files are sent to the workers in batches to
+    amortize the cost of pickling them, and only a couple of batches per CPU
+    are queued at any time.
+    """
+
+    max_pending = 2 * (os.cpu_count() or 1)
+    batches = batched(filenames, batch_size)
+    futures = set()
+    with ProcessPoolExecutor() as executor:
+        while True:
+            for batch in islice(batches, max_pending - len(futures)):
+                futures.add(executor.submit(parse_video_files_batch, batch, slow))
+            if not futures:
+                break
+
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    """
+    Splits an iterable into lists of length `n`. The last list may be shorter.
+    """
+
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
+
+
+def load_cache() -> dict[str, CacheEntry]:
+    """
+    Loads the metadata cache from disk. A missing or corrupted cache file yields
+    an empty cache.
+    """
+
+    try:
+        return msgspec.msgpack.decode(CACHE_FILE.read_bytes(), type=dict[str, CacheEntry])
+    except (OSError, msgspec.DecodeError):
+        return {}
+
+
+def save_cache(cache: dict[str, CacheEntry]) -> None:
+    """
+    Writes the metadata cache to disk. The file is replaced atomically, so an
+    interrupted write never leaves a truncated cache behind. Failing to write
+    the cache is not an error, it just won't speed up the next run.
     """
 
+    tmp_file = CACHE_FILE.with_name(f"{CACHE_FILE.name}.{os.getpid()}.tmp")
     try:
-        # Tries to retrieve video metadata in JSON format
-        probe = ffmpeg.probe(filename)
-        info = next(s for s in probe.get("streams")
-                    if s.get("codec_type") == "video")
-
-        # Build VideoInfo object from JSON metadata
-        frame_rate = int(info.get("r_frame_rate").split("/")[0])
-        width = int(info.get("width"))
-        height = int(info.get("height"))
-        timestamp = info.get("tags").get("creation_time")
-
-        return VideoInfo(
-            path=filename,
-            fps=frame_rate,
-            resolution=(width, height),
-            creation_time=datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-        )
-    except ffmpeg.Error as e:
-        # TODO: handle error instead of just ignoring it
-        pass
-
-
-def rename_video_file(video_info: VideoInfo, prefix: str = "", dry_run: bool = True, verbose: int = 0) -> None:
-    """
-    Renames a video file base on its metadata.
-    """
-
-    # Build filename from video metadata
-    SEP = "_"
-    resolution = f"{video_info.resolution[0]}x{video_info.resolution[1]}"
-    fps = f"{video_info.fps}fps"
-    creation_time = video_info.creation_time.strftime("%Y-%m-%dT%H%M%S")
-    metadata = SEP.join([resolution, fps, creation_time])
-    prefix = prefix if prefix else video_info.path.stem
-    new_filename = prefix + SEP + metadata + video_info.path.suffix.lower()
+        CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file.write_bytes(msgspec.msgpack.encode(cache))
+        os.replace(tmp_file, CACHE_FILE)
+    except OSError:
+        with suppress(OSError):
+            tmp_file.unlink(missing_ok=True)
+
+
+def filename_formatter(prefix: str = "") -> Callable[..., str]:
+    """
+    Returns a function building filenames out of `(stem, width, height, fps,
+    creation_time, suffix)`. A non-empty prefix replaces the original stem and
+    is baked into the format template up front, so each call boils down to a
+    single `str.format`.
+    """
+
+    template = "_{1}x{2}_{3}fps_{4:%Y-%m-%dT%H%M%S}{5}"
+    if prefix:
+        # Braces in the prefix must not be mistaken for replacement fields
+        return (prefix.replace("{", "{{").replace("}", "}}") + template).format
+    return ("{0}" + template).format
+
+
+def rename_video_file(table: VideoTable, i: int, format_filename: Callable[..., str], dry_run: bool = True, verbose: int = 0) -> None:
+    """
+    Renames the i-th video file of a table base on its metadata.
+    """
+
+    # Build filename from video metadata. Paths are split as plain strings,
+    # sparing a `Path` object for every file
+    path = table.paths[i]
+    parent, filename = os.path.split(path)
+    stem, suffix = os.path.splitext(filename)
+    new_filename = format_filename(stem, table.widths[i], table.heights[i], table.fps[i],
+                                   table.creation_time(i), suffix.lower())
 
     # Rename video
-    p = Path.joinpath(video_info.path.parent, new_filename)
+    p = os.path.join(parent, new_filename)
     if verbose >= 2:
-        print(f"Renaming `{video_info.path}` to `{p}`")
+        print(f"Renaming `{path}` to `{p}`")
+
+    if not dry_run:
+        # Never overwrite another video that ended up with the same metadata
+        if os.path.lexists(p):
+            print(f"Skipping `{path}`: `{p}` already exists")
+            return
+        os.replace(path, p)
 
 
-async def main():
+def main():
     """
     Entry point for application logic.
     """
 
     args = parse_args()
-    # Create list of tasks and run them concurrently
-    tasks = []
-    loop = asyncio.get_running_loop()
-    for input_file in args.input_files:
-        tasks.append(loop.run_in_executor(None, parse_video_file, input_file))
+    cache = load_cache()
+    format_filename = filename_formatter(args.prefix)
 
     if args.verbose >= 1:
-        print(f"Extracted metadata from {len(tasks)} video files")
+        print(f"Renaming {len(args.input_files)} video files...")
+
+    # Reuse metadata from previous runs for files that didn't change since
+    cached = VideoTable()
+    pending = {}
+    seen = set()
+    skipped = 0
+    for filename in args.input_files:
+        # Files that were already renamed don't need to be parsed at all
+        if RENAMED_PATTERN.search(filename):
+            skipped += 1
+            continue
+
+        key = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            # File vanished since the directory was walked
+            continue
+
+        seen.add(key)
+        entry = cache.get(key)
+        if entry and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+            cached.append(filename, entry.fps, entry.width, entry.height, entry.creation_time)
+        else:
+            pending[filename] = (key, st)
 
-    metadata_tasks = [await task for task in tasks]
     if args.verbose >= 1:
-        print(f"Renaming {len(metadata_tasks)} video files...")
+        print(f"Skipped {skipped} video files that were already renamed")
+        print(f"Found cached metadata for {len(cached)} video files")
 
-    for video in metadata_tasks:
-        rename_video_file(video, args.prefix, verbose=args.verbose)
+    for i in range(len(cached)):
+        rename_video_file(cached, i, format_filename, verbose=args.verbose)
+
+    # Parse remaining video files, renaming them as soon as their batch is done.
+    # The cache is saved even if the run fails halfway, keeping what was parsed
+    parsed = 0
+    try:
+        for table in parse_video_files(pending, args.slow):
+            parsed += len(table)
+            for i in range(len(table)):
+                key, st = pending[table.paths[i]]
+                cache[key] = CacheEntry(
+                    mtime_ns=st.st_mtime_ns,
+                    size=st.st_size,
+                    fps=table.fps[i],
+                    width=table.widths[i],
+                    height=table.heights[i],
+                    creation_time=table.creation_time(i)
+                )
+                rename_video_file(table, i, format_filename, verbose=args.verbose)
+    finally:
+        # Drop entries of files that were deleted, moved or renamed since
+        save_cache({key: entry for key, entry in cache.items() if key in seen})
 
     if args.verbose >= 1:
+        print(f"Extracted metadata from {parsed} video files")
         print(f"Done!")
 
 
@@ -171,4 +571,4 @@ async def main():
 #
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()